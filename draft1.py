@@ -1,10 +1,23 @@
+import os
+import argparse
 import taichi as ti
 from eng.gguishow import *
 from eng.particle_system import *
 from eng.wcsesph import *
 
-# ti.init(arch=ti.cpu, debug=True)
-ti.init(arch=ti.cuda, packed=True, device_memory_fraction=0.75)     # MEMORY max 4G in GUT, 6G in Legion
+parser = argparse.ArgumentParser()
+parser.add_argument("--debug", action="store_true", help="init taichi in debug mode on cpu, with bound checks and without optimization")
+parser.add_argument("--cpu", action="store_true", help="run on cpu instead of cuda")
+parser.add_argument("--profile", action="store_true", help="print the kernel profiler info after the window is closed")
+args, _ = parser.parse_known_args()
+
+if args.debug:
+    ti.init(arch=ti.cpu, debug=True)
+elif args.cpu:
+    ti.init(arch=ti.cpu, advanced_optimization=True, fast_math=True, cpu_max_num_threads=os.cpu_count(), default_fp=ti.f32, debug=False, kernel_profiler=args.profile)
+else:
+    # saturating_grid_dim is left to taichi, which sets it from the number of SMs and the max blocks per SM of the device
+    ti.init(arch=ti.cuda, packed=True, device_memory_fraction=0.75, advanced_optimization=True, fast_math=True, default_fp=ti.f32, debug=False, kernel_profiler=args.profile)     # MEMORY max 4G in GUT, 6G in Legion
 
 if __name__ == "__main__":
     print("hallo tiSPHi TEST!")
@@ -15,11 +28,16 @@ if __name__ == "__main__":
     particle_radius = 0.001
     cube_size = [0.146, 0.292]
 
-    case1 = ParticleSystem(rec_world, particle_radius)
-    case1.add_cube(lower_corner=[0.0, 0], cube_size=cube_size, material=1, density=1000.0)
+    cube_lower_corner = [0.0, 0]
+
+    case1 = ParticleSystem(rec_world, particle_radius, case_num=ParticleSystem.cube_particles_num(cube_lower_corner, cube_size, particle_radius))   # sized for the fluid cube
+    case1.add_cube(lower_corner=cube_lower_corner, cube_size=cube_size, material=1, density=1000.0, defer_init=True)   # NS is rebuilt in the first solver step
 
     solver = WCSESPHSolver(case1, TDmethod=1, kernel=2, visco=0.00005, stiff=50000, expo=7)
 
     gguishow(case1, solver, rec_world, screen_to_world_ratio, stepwise=20, iparticle=None, color_title="density N/m3", kradius=1.5, write_to_disk=0, pause=False)
     # color title: pressure Pa; velocity m/s; density N/m3; d density N/m3/s;
     # * SPACE for pause/run, ESC for terminate, left click for showing the info of position and grid index
+
+    if args.profile:
+        ti.profiler.print_kernel_profiler_info()
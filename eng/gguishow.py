@@ -35,7 +35,8 @@ def gguishow(case, solver, world, s2w_ratio, kradius=1.25, color_title="Null", c
             if iparticle is None:
                 print('---- step %d' % (flag_step))
             else:
-                print('---- step %d, p[%d]: x=(%.3f, %.3f), u=(%.3f, %.3f), rho=%.3f, neighbour=%d' % (flag_step, iparticle, case.x[iparticle][0], case.x[iparticle][1], case.u[iparticle][0], case.u[iparticle][1], case.density[iparticle], case.particle_neighbors_num[iparticle]))
+                i = case.id_to_index(iparticle)    # particles are reordered by the solver, follow the same particle
+                print('---- step %d, p[%d]: x=(%.3f, %.3f), u=(%.3f, %.3f), rho=%.3f, neighbour=%d' % (flag_step, iparticle, case.x[i][0], case.x[i][1], case.u[i][0], case.u[i][1], case.density[i], case.particle_neighbors_num[i]))
             for i in range(stepwise):
                 solver.step()
                 flag_step += 1
@@ -43,8 +44,7 @@ def gguishow(case, solver, world, s2w_ratio, kradius=1.25, color_title="Null", c
         # draw particles
         case.copy2vis(s2w_ratio, max_res)
         solver.init_value()
-        case.v_maxmin()
-        case.set_color()
+        case.cal_color()
         draw_radius = case.particle_radius * s2w_ratio * kradius / max_res
         canvas.circles(case.pos2vis, radius=draw_radius, per_vertex_color=case.color)
 
@@ -2,7 +2,7 @@ import taichi as ti
 import numpy as np
 import matplotlib as mpl
 from eng.colormap import *
-from functools import reduce    # 整数：累加；字符串、列表、元组：拼接。lambda为使用匿名函数
+from math import prod
 
 # TODO: --ok Unify all coordinate systems and put padding area outside the real world.
 # TODO: --ok still warnings in NS, offset loop die for endless
@@ -11,7 +11,7 @@ from functools import reduce    # 整数：累加；字符串、列表、元组
 
 @ti.data_oriented
 class ParticleSystem:
-    def __init__(self, world, radius):
+    def __init__(self, world, radius, case_num=None):
         print("Class Particle System starts to serve!")
 
         # Basic information of the simulation
@@ -32,10 +32,10 @@ class ParticleSystem:
         self.kh = 1.2   # times the support domain radius to the particle radius. Should be adapted automaticlly soon
         self.smoothing_len = self.kh * self.particle_diameter
         self.support_radius = self.kappa * self.smoothing_len
+        self.support_radius_sq = self.support_radius**2   # compared with squared distances in NS, no sqrt needed
         self.m_V = self.particle_diameter**self.dim     # m2 or m3 for cubic discrete
-        self.particle_max_num = 2**16  # the max number of all particles, as 65536
-        self.particle_max_num_per_cell = 100  # the max number of particles in each cell
-        self.particle_max_num_neighbors = 100  # the max number of neighbour particles of each particle
+        self.particle_avg_num_neighbors = 40  # the average number of neighbour particles of each particle, sizes the packed neighbour list
+        self.neighbor_batch = 4  # number of candidate particles of a cell tested together in NS
         self.particle_num = ti.field(int, shape=())  # record the number of current particles
 
         # Grid property 背景格网的基本属性
@@ -43,8 +43,15 @@ class ParticleSystem:
         self.bound = [[-self.grid_size, -self.grid_size], [i + self.grid_size for i in world]]    # Simply create a rectangular range, down-left and up-right
         self.range = np.array([self.bound[1][0] - self.bound[0][0], self.bound[1][1] - self.bound[0][1]])    # Simply create a rectangular range
         self.grid_num = np.ceil(self.range / self.grid_size).astype(int)  # 格网总数
+        # the max number of particles in each cell: particles of a cell at rest with 50% slack, padded to a multiple of neighbor_batch
+        self.particle_max_num_per_cell = int(np.ceil((self.grid_size / self.particle_diameter)**self.dim * 1.5 / self.neighbor_batch)) * self.neighbor_batch
         self.grid_particles_num = ti.field(int)  # 每个格网中的粒子总数
         self.grid_particles = ti.field(int)  # 每个格网中的粒子编号
+        self.grid_overflow = ti.field(int, shape=())  # number of particles left out of full cells in the last allocation
+
+        # the max number of all particles: the rangeary dummy particles plus case_num particles added by the case, by default the world filled with particles
+        self.rangeary_num = sum(self.cube_particles_num(dl, tr - dl, self.particle_radius) for dl, tr in self.rangeary_cubes())
+        self.particle_max_num = self.rangeary_num + (case_num if case_num is not None else int(np.prod(np.ceil(self.world / self.particle_diameter))))
 
         # Particle related property 粒子携带的属性信息
         # Basic
@@ -53,8 +60,12 @@ class ParticleSystem:
         self.L = ti.Matrix.field(self.dim, self.dim, dtype=float)     # the normalised matrix
         self.val = ti.field(dtype=float)                      # store a value
         self.particle_neighbors_num = ti.field(int)         # total number of neighbour particles
-        self.particle_neighbors = ti.field(int)             # index of neighbour particles
+        self.particle_neighbors_offset = ti.field(int, shape=self.particle_max_num + 1)    # start of each particle's neighbours in the packed list, CSR
+        self.particle_neighbors = ti.field(int, shape=self.particle_max_num * self.particle_avg_num_neighbors)   # index of neighbour particles, packed CSR
+        self.neighbor_scan_block = max(32, int(np.sqrt(self.particle_max_num)))    # particles per block of the offset scan, both serial parts of the scan stay O(sqrt(n))
+        self.particle_neighbors_block_offset = ti.field(int, shape=(self.particle_max_num + self.neighbor_scan_block - 1) // self.neighbor_scan_block + 1)    # start of each scan block in the packed list
         self.material = ti.field(dtype=int)                 # material type
+        self.particle_id = ti.field(dtype=int)              # index of the particle when it was added, kept through reorder_by_morton
         # self.color = ti.field(dtype=int)                    # color in drawing for gui
         self.color = ti.Vector.field(3, dtype=float)     # color in drawing for ggui
         # Paras
@@ -70,20 +81,26 @@ class ParticleSystem:
         self.vminmin = ti.field(float, shape=())
 
         # Place nodes on root
-        self.particles_node = ti.root.dense(ti.i, self.particle_max_num)    # 使用稠密数据结构开辟每个粒子数据的存储空间，按列存储
-        self.particles_node.place(self.x, self.pos2vis, self.L, self.val, self.material, self.color)
-        self.particles_node.place(self.density, self.u, self.stress, self.strain)
-        self.particles_node.place(self.particle_neighbors_num)
-        self.particle_node = self.particles_node.dense(ti.j, self.particle_max_num_neighbors)    # 使用稠密数据结构开辟每个粒子邻域粒子编号的存储空间，按行存储
-        self.particle_node.place(self.particle_neighbors)
+        # * SoA layout: one dense node per group of co-accessed fields, so the neighbour loops only stream the bytes they need
+        ti.root.dense(ti.i, self.particle_max_num + 1).place(self.x)    # hot: NS and every neighbour loop, the extra one is the far away sentinel padding the cells
+        ti.root.dense(ti.i, self.particle_max_num).place(self.material, self.particle_neighbors_num)    # hot: per particle flags in neighbour loops
+        ti.root.dense(ti.i, self.particle_max_num).place(self.u, self.density)    # warm: solver paras
+        ti.root.dense(ti.i, self.particle_max_num).place(self.L)
+        ti.root.dense(ti.i, self.particle_max_num).place(self.stress, self.strain)
+        ti.root.dense(ti.i, self.particle_max_num).place(self.val, self.color, self.pos2vis, self.particle_id)    # cold: visualization and debug only
 
         grid_index = ti.ij if self.dim == 2 else ti.ijk          # 建立格网维度索引变量，xy or xyz
-        grid_node = ti.root.dense(grid_index, self.grid_num)     # 使用稠密数据结构开辟每个格网中粒子总数的存储空间
+        self.grid_block_size = 8     # cells in each direction of a sparse grid block
+        self.grid_block = ti.root.pointer(grid_index, tuple((g + self.grid_block_size - 1) // self.grid_block_size for g in self.grid_num))   # 使用稀疏数据结构，只有含粒子的格网块被激活
+        grid_node = self.grid_block.bitmasked(grid_index, (self.grid_block_size,) * self.dim)     # 每个格网中粒子总数的存储空间，未激活的格网读为0
         grid_node.place(self.grid_particles_num)
         cell_index = ti.k if self.dim == 2 else ti.l        # 建立粒子索引变量
         cell_node = grid_node.dense(cell_index, self.particle_max_num_per_cell)     # 使用稠密数据结构开辟每个格网中存储粒子编号的存储空间
         cell_node.place(self.grid_particles)
 
+        self.sentinel = self.particle_max_num
+        self.x[self.sentinel] = [1e10] * self.dim
+
         # Create rectangle rangeary particles
         self.gen_rangeary_particles()
 
@@ -95,51 +112,149 @@ class ParticleSystem:
     def pos_to_index(self, pos):
         return ((pos - self.bound[0]) / self.grid_size).cast(int)
 
-    @ti.func
-    def is_valid_cell(self, cell):
-        # Check whether the cell is in the grid
-        flag = True
-        for d in ti.static(range(self.dim)):
-            flag = flag and (0 <= cell[d] < self.grid_num[d])
-        return flag
-
     @ti.kernel
     def allocate_particles_to_grid(self):
+        self.grid_overflow[None] = 0
         for p in range(self.particle_num[None]):
             cell = self.pos_to_index(self.x[p])
             offset = ti.atomic_add(self.grid_particles_num[cell], 1)
-            self.grid_particles[cell, offset] = p
+            if offset < self.particle_max_num_per_cell:
+                self.grid_particles[cell, offset] = p
+            else:
+                ti.atomic_add(self.grid_overflow[None], 1)
 
     @ti.kernel
-    def search_neighbors(self):
+    def pad_grid_particles(self):
+        # * fill the tail of each cell up to a multiple of neighbor_batch with the sentinel, which is out of the support domain of any particle
+        for cell in ti.grouped(self.grid_particles_num):
+            num = ti.min(self.grid_particles_num[cell], self.particle_max_num_per_cell)
+            self.grid_particles_num[cell] = num
+            for j in range(num, (num + self.neighbor_batch - 1) // self.neighbor_batch * self.neighbor_batch):
+                self.grid_particles[cell, j] = self.sentinel
+
+    # check a batch of neighbor_batch candidates, the b-th batch of the cell, for particle p_i
+    # return their indices, with -1 for candidates out of the support domain, including the sentinel padding
+    @ti.func
+    def neighbors_in_batch(self, p_i, cell, b):
+        p_j = ti.Vector([0 for _ in range(self.neighbor_batch)])
+        distance_sq = ti.Vector([0.0 for _ in range(self.neighbor_batch)])
+        for k in ti.static(range(self.neighbor_batch)):
+            p_j[k] = self.grid_particles[cell, b * self.neighbor_batch + k]
+            dx = self.x[p_i] - self.x[p_j[k]]
+            distance_sq[k] = dx.dot(dx)
+        res = ti.Vector([-1 for _ in range(self.neighbor_batch)])
+        for k in ti.static(range(self.neighbor_batch)):
+            if p_j[k] != p_i and distance_sq[k] < self.support_radius_sq:
+                res[k] = p_j[k]
+        return res
+
+    # * neighbour list is stored as CSR: particle_neighbors[particle_neighbors_offset[p_i]:particle_neighbors_offset[p_i + 1]]
+    @ti.kernel
+    def count_neighbors(self):
         for p_i in range(self.particle_num[None]):
+            cnt = 0
             # Skip rangeary particles
-            if self.material[p_i] == self.material_dummy:
+            if self.material[p_i] != self.material_dummy:
+                center_cell = self.pos_to_index(self.x[p_i])
+                # stencil of the neighbouring cells clamped to the grid, every iterated cell is valid
+                lo = ti.max(center_cell - 1, 0)
+                hi = ti.min(center_cell + 2, ti.Vector(self.grid_num))
+                for cell in ti.grouped(ti.ndrange(*[(lo[d], hi[d]) for d in ti.static(range(self.dim))])):
+                    for b in range((self.grid_particles_num[cell] + self.neighbor_batch - 1) // self.neighbor_batch):
+                        cnt += ti.cast(self.neighbors_in_batch(p_i, cell, b) >= 0, int).sum()   # cast the mask, a bool sum is not a count
+            self.particle_neighbors_num[p_i] = cnt
+
+    @ti.kernel
+    def scan_neighbors_offset(self):
+        # * blocked exclusive prefix sum of the neighbour numbers: sum the blocks in parallel, scan the few block sums serially, then scan inside the blocks in parallel
+        n = self.particle_num[None]
+        block = ti.static(self.neighbor_scan_block)
+        block_num = (n + block - 1) // block
+        for b in range(block_num):
+            cnt = 0
+            for p_i in range(b * block, ti.min(b * block + block, n)):
+                cnt += self.particle_neighbors_num[p_i]
+            self.particle_neighbors_block_offset[b + 1] = cnt
+        self.particle_neighbors_block_offset[0] = 0
+        ti.loop_config(serialize=True)
+        for b in range(block_num):
+            self.particle_neighbors_block_offset[b + 1] += self.particle_neighbors_block_offset[b]
+        for b in range(block_num):
+            start = self.particle_neighbors_block_offset[b]
+            for p_i in range(b * block, ti.min(b * block + block, n)):
+                self.particle_neighbors_offset[p_i] = start
+                start += self.particle_neighbors_num[p_i]
+        self.particle_neighbors_offset[n] = self.particle_neighbors_block_offset[block_num]
+
+    @ti.kernel
+    def fill_neighbors(self):
+        for p_i in range(self.particle_num[None]):
+            start = self.particle_neighbors_offset[p_i]
+            end = self.particle_neighbors_offset[p_i + 1]
+            if end == start:
                 continue
             center_cell = self.pos_to_index(self.x[p_i])
-            cnt = 0
-            for offset in ti.grouped(ti.ndrange(*((-1, 2),) * self.dim)):
-                if cnt >= self.particle_max_num_neighbors:
+            cnt = start
+            lo = ti.max(center_cell - 1, 0)
+            hi = ti.min(center_cell + 2, ti.Vector(self.grid_num))
+            for cell in ti.grouped(ti.ndrange(*[(lo[d], hi[d]) for d in ti.static(range(self.dim))])):
+                if cnt >= end:
                     break
-                cell = center_cell + offset
-                if not self.is_valid_cell(cell):
-                    continue
-                for j in range(self.grid_particles_num[cell]):
-                    p_j = self.grid_particles[cell, j]
-                    distance = (self.x[p_i] - self.x[p_j]).norm()
-                    if p_i != p_j and distance < self.support_radius:
-                        self.particle_neighbors[p_i, cnt] = p_j
-                        cnt += 1
-            self.particle_neighbors_num[p_i] = cnt
+                for b in range((self.grid_particles_num[cell] + self.neighbor_batch - 1) // self.neighbor_batch):
+                    p_j = self.neighbors_in_batch(p_i, cell, b)
+                    for k in ti.static(range(self.neighbor_batch)):
+                        if p_j[k] >= 0 and cnt < end:
+                            self.particle_neighbors[cnt] = p_j[k]
+                            cnt += 1
+
+    # count the neighbours and build the CSR offsets, the packed list must hold all of them
+    def build_neighbors_offset(self):
+        self.count_neighbors()
+        self.scan_neighbors_offset()
+        neighbors_total = self.particle_neighbors_offset[self.particle_num[None]]
+        assert neighbors_total <= self.particle_neighbors.shape[0], 'My Error: %d neighbours exceed the packed list of %d, increase particle_avg_num_neighbors!' % (neighbors_total, self.particle_neighbors.shape[0])
+
+    def search_neighbors(self):
+        self.build_neighbors_offset()
+        self.fill_neighbors()
 
     ###########################################################################
     # Initialise and Update the particle system b
     ###########################################################################
-    def initialize_particle_system(self):
-        self.grid_particles_num.fill(0)
-        self.particle_neighbors.fill(-1)
+    def initialize_particle_system(self, fill_list=True):
+        # * fill_list=False only prepares the CSR offsets, the packed list is then filled by a fused solver kernel, e.g. SPHSolver.neighbor_iter_and_cal_L
+        self.grid_block.deactivate_all()
         self.allocate_particles_to_grid()
-        self.search_neighbors()
+        assert self.grid_overflow[None] == 0, 'My Error: %d particles exceed particle_max_num_per_cell = %d!' % (self.grid_overflow[None], self.particle_max_num_per_cell)
+        self.pad_grid_particles()
+        if fill_list:
+            self.search_neighbors()
+        else:
+            self.build_neighbors_offset()
+
+    # * sort particles by the Morton code of their cell, so that particles close in space are close in memory
+    # * the neighbour list refers to old indices and must be rebuilt by initialize_particle_system afterwards
+    # * particle_id moves with the particles, use id_to_index to follow one particle
+    def reorder_by_morton(self):
+        n = self.particle_num[None]
+        if n == 0:
+            return
+        cell = ((self.x.to_numpy()[:n] - np.array(self.bound[0])) / self.grid_size).astype(np.int64)
+        cell = np.clip(cell, 0, self.grid_num - 1)
+        bits = int(self.grid_num.max() - 1).bit_length()
+        code = np.zeros(n, dtype=np.int64)
+        for b in range(bits):
+            for d in range(self.dim):
+                code |= ((cell[:, d] >> b) & 1) << (b * self.dim + d)
+        order = np.argsort(code, kind='stable')
+        for field in (self.x, self.u, self.density, self.stress, self.strain, self.material, self.color, self.val, self.particle_id):
+            arr = field.to_numpy()
+            arr[:n] = arr[:n][order]
+            field.from_numpy(arr)
+
+    # current index of the particle with the given particle_id
+    def id_to_index(self, pid):
+        return int(np.flatnonzero(self.particle_id.to_numpy()[:self.particle_num[None]] == pid)[0])
 
     ###########################################################################
     # Add particles
@@ -155,18 +270,19 @@ class ParticleSystem:
         self.strain[p] = strain
         self.material[p] = material
         self.color[p] = color
+        self.particle_id[p] = p
 
-    # add particles with given properties
+    # add particles with given properties, the NumPy arrays are passed as ndarray arguments: read in place on cpu, staged through a host-device copy on cuda
     @ti.kernel
     def add_particles(self, new_particles_num: int,
-                      new_particles_value: ti.ext_arr(),
-                      new_particles_positions: ti.ext_arr(),
-                      new_particles_velocity: ti.ext_arr(),
-                      new_particles_density: ti.ext_arr(),
-                      new_particles_stress: ti.ext_arr(),
-                      new_particles_strain: ti.ext_arr(),
-                      new_particles_material: ti.ext_arr(),
-                      new_particles_color: ti.ext_arr()):
+                      new_particles_value: ti.types.ndarray(),
+                      new_particles_positions: ti.types.ndarray(),
+                      new_particles_velocity: ti.types.ndarray(),
+                      new_particles_density: ti.types.ndarray(),
+                      new_particles_stress: ti.types.ndarray(),
+                      new_particles_strain: ti.types.ndarray(),
+                      new_particles_material: ti.types.ndarray(),
+                      new_particles_color: ti.types.ndarray()):
         for p in range(self.particle_num[None],
                        self.particle_num[None] + new_particles_num):
             new_p = p - self.particle_num[None]
@@ -192,19 +308,8 @@ class ParticleSystem:
     ###########################################################################
     # Generate boundary particles
     ###########################################################################
-    # 增加 padding region 中所有方向上矩形边界的粒子，2d
-    def gen_one_rangeary_cube(self, dl, tr, color, type, voff):
-        self.add_cube(lower_corner=dl,
-                      cube_size=tr - dl,
-                      material=type,
-                      color=color,
-                      offset=voff)
-
-    def gen_rangeary_particles(self):
-        Dummy_color = (153/255, 153/255, 255/255)
-        # Dummy_color = 0x9999FF
-        Dummy_type = 10
-        Dummy_off = self.particle_diameter
+    # lower-left and upper-right corners of the four rectangles in the padding region, 2d
+    def rangeary_cubes(self):
         Dummy_cube_d_dl = np.array(self.bound[0])
         Dummy_cube_d_tr = np.array([self.bound[1][0], 0])
         Dummy_cube_u_dl = np.array([self.bound[0][0], self.bound[1][1] - self.grid_size])
@@ -213,16 +318,27 @@ class ParticleSystem:
         Dummy_cube_l_tr = np.array([0, self.bound[1][1] - self.grid_size])
         Dummy_cube_r_dl = np.array([self.bound[1][0] - self.grid_size, 0])
         Dummy_cube_r_tr = np.array([self.bound[1][0], self.bound[1][1] - self.grid_size])
-        self.gen_one_rangeary_cube(Dummy_cube_d_dl, Dummy_cube_d_tr, Dummy_color, Dummy_type, Dummy_off)
-        self.gen_one_rangeary_cube(Dummy_cube_u_dl, Dummy_cube_u_tr, Dummy_color, Dummy_type, Dummy_off)
-        self.gen_one_rangeary_cube(Dummy_cube_l_dl, Dummy_cube_l_tr, Dummy_color, Dummy_type, Dummy_off)
-        self.gen_one_rangeary_cube(Dummy_cube_r_dl, Dummy_cube_r_tr, Dummy_color, Dummy_type, Dummy_off)
+        return ((Dummy_cube_d_dl, Dummy_cube_d_tr), (Dummy_cube_u_dl, Dummy_cube_u_tr),
+                (Dummy_cube_l_dl, Dummy_cube_l_tr), (Dummy_cube_r_dl, Dummy_cube_r_tr))
+
+    # 增加 padding region 中所有方向上矩形边界的粒子，2d
+    def gen_rangeary_particles(self):
+        Dummy_color = (153/255, 153/255, 255/255)
+        # Dummy_color = 0x9999FF
+        Dummy_type = 10
+        Dummy_off = self.particle_diameter
+        # * build the four cubes in NumPy and add them with one kernel launch and one NS
+        cubes = [self.gen_cube_particles(lower_corner=dl, cube_size=tr - dl, material=Dummy_type, color=Dummy_color, offset=Dummy_off)
+                 for dl, tr in self.rangeary_cubes()]
+        self.add_new_particles([np.concatenate(arrays) for arrays in zip(*cubes)])
+        self.initialize_particle_system()
         print("rangeary dummy particles' number: ", self.particle_num)
 
     ###########################################################################
     # Generate particles in rules
     ###########################################################################
     # add particles in a cube region
+    # defer_init=True skips the NS, e.g. when more particles are added right after or the solver step rebuilds it anyway
     def add_cube(self,
                  lower_corner,
                  cube_size,
@@ -233,66 +349,95 @@ class ParticleSystem:
                  density=None,
                  stress=None,
                  strain=None,
-                 offset=None):
-        num_dim = []
-        range_offset = offset if offset is not None else self.particle_diameter
-        for i in range(self.dim):
-            num_dim.append(np.arange(lower_corner[i] + self.particle_radius, lower_corner[i] + cube_size[i] + 1e-5, range_offset))
-        num_new_particles = reduce(lambda x, y: x * y, [len(n) for n in num_dim])
+                 offset=None,
+                 defer_init=False):
+        self.add_new_particles(self.gen_cube_particles(lower_corner, cube_size, material, color, value, velocity, density, stress, strain, offset))
+        if not defer_init:
+            self.initialize_particle_system()
+
+    # add the arrays generated by gen_cube_particles, in the argument order of add_particles
+    def add_new_particles(self, new_particles):
+        num_new_particles = len(new_particles[0])
         assert self.particle_num[None] + num_new_particles <= self.particle_max_num, 'My Error: exceed the maximum number of particles!'
+        self.add_particles(num_new_particles, *new_particles)
+
+    # coordinates of the particles in a cube region along each axis, static to size a case before its particle system is built
+    @staticmethod
+    def cube_axes(lower_corner, cube_size, radius, offset=None):
+        range_offset = offset if offset is not None else 2.0 * radius
+        return [np.arange(lower_corner[i] + radius, lower_corner[i] + cube_size[i] + 1e-5, range_offset) for i in range(len(cube_size))]
+
+    @staticmethod
+    def cube_particles_num(lower_corner, cube_size, radius, offset=None):
+        return prod(len(n) for n in ParticleSystem.cube_axes(lower_corner, cube_size, radius, offset))
+
+    # generate the NumPy arrays of the particles in a cube region
+    def gen_cube_particles(self,
+                           lower_corner,
+                           cube_size,
+                           material,
+                           color=(1, 1, 1),
+                           value=None,
+                           velocity=None,
+                           density=None,
+                           stress=None,
+                           strain=None,
+                           offset=None):
+        num_dim = self.cube_axes(lower_corner, cube_size, self.particle_radius, offset)
+        num_new_particles = prod(len(n) for n in num_dim)
 
-        new_positions = np.array(np.meshgrid(*num_dim, sparse=False, indexing='ij' if self.dim == 2 else 'ijk'), dtype=np.float32)
-        new_positions = new_positions.reshape(-1, reduce(lambda x, y: x * y, list(new_positions.shape[1:]))).transpose()
+        new_positions = np.stack(np.meshgrid(*num_dim, sparse=False, indexing='ij'), axis=-1).reshape(-1, self.dim).astype(np.float32)
         print("New cube's number and dim: ", new_positions.shape)
 
+        # * broadcast the per cube properties to all new particles without per particle Python objects
         if color is None:
-            color = np.zeros((num_new_particles, 3))
+            color = np.zeros((num_new_particles, 3), dtype=np.float32)
         else:
-            color = np.array([color for _ in range(num_new_particles)], dtype=np.float32)
+            color = np.broadcast_to(np.asarray(color, dtype=np.float32), (num_new_particles, 3)).copy()
         if velocity is None:
-            velocity = np.full_like(new_positions, 0)
+            velocity = np.zeros_like(new_positions)
         else:
-            velocity = np.array([velocity for _ in range(num_new_particles)], dtype=np.float32)
+            velocity = np.broadcast_to(np.asarray(velocity, dtype=np.float32), (num_new_particles, self.dim)).copy()
         if stress is None:
-            stress = np.array([np.zeros((self.dim, self.dim)) for _ in range(num_new_particles)], dtype=np.float32)
+            stress = np.zeros((num_new_particles, self.dim, self.dim), dtype=np.float32)
         else:
-            stress = np.array([stress for _ in range(num_new_particles)], dtype=np.float32)
+            stress = np.broadcast_to(np.asarray(stress, dtype=np.float32), (num_new_particles, self.dim, self.dim)).copy()
         if strain is None:
-            strain = np.array([np.zeros((self.dim, self.dim)) for _ in range(num_new_particles)], dtype=np.float32)
+            strain = np.zeros((num_new_particles, self.dim, self.dim), dtype=np.float32)
         else:
-            strain = np.array([strain for _ in range(num_new_particles)], dtype=np.float32)
+            strain = np.broadcast_to(np.asarray(strain, dtype=np.float32), (num_new_particles, self.dim, self.dim)).copy()
 
-        value = np.full_like(np.zeros(num_new_particles), value if value is not None else 0.0)
-        density = np.full_like(np.zeros(num_new_particles), density if density is not None else 0.0)
-        material = np.full_like(np.zeros(num_new_particles), material)
-        self.add_particles(num_new_particles, value, new_positions, velocity, density, stress, strain, material, color)
-        self.initialize_particle_system()
+        value = np.full(num_new_particles, value if value is not None else 0.0, dtype=np.float32)
+        density = np.full(num_new_particles, density if density is not None else 0.0, dtype=np.float32)
+        material = np.full(num_new_particles, material, dtype=np.int32)
+        return value, new_positions, velocity, density, stress, strain, material, color
 
     ###########################################################################
     # Assist
     ###########################################################################
+    # * pos2vis and color stay in f32: ggui of taichi 1.0 rejects other dtypes, and later versions read u8 colors without normalising them to [0, 1]
     @ti.kernel
     def copy2vis(self, s2w_ratio: float, max_res: int):
+        scale = s2w_ratio / max_res
         for i in range(self.particle_num[None]):
-            for j in ti.static(range(self.dim)):
-                self.pos2vis[i][j] = (self.x[i][j] + self.grid_size) * s2w_ratio / max_res
+            self.pos2vis[i] = (self.x[i] + self.grid_size) * scale
 
-    @ti.kernel
-    def v_maxmin(self):
-        vmax = -float('Inf')
-        vmin = float('Inf')
+    @ti.func
+    def val_to_color(self):
+        vrange1 = 1 / ti.max(self.vmax[None] - self.vmin[None], 1e-12)  # guard against equal max and min value
         for i in range(self.particle_num[None]):
             if self.material[i] < 10:
-                ti.atomic_max(vmax, self.val[i])
-                ti.atomic_min(vmin, self.val[i])
-        self.vmax[None] = vmax
-        self.vmin[None] = vmin
+                # self.color[i] = ti.Vector([1, (self.vmax[None] - self.val[i]) * vrange1, 0])  # Change the second value of RGB, from yellow to red
+                tmp = (self.val[i] - self.vmin[None]) * vrange1
+                self.color[i] = color_map(tmp)
 
+    # value range and colors of the non-dummy particles in one kernel launch
     @ti.kernel
-    def set_color(self):
-        vrange1 = 1 / (self.vmax[None] - self.vmin[None])
+    def cal_color(self):
+        self.vmax[None] = -float('Inf')
+        self.vmin[None] = float('Inf')
         for i in range(self.particle_num[None]):
             if self.material[i] < 10:
-                # self.color[i] = ti.Vector([1, (self.vmax[None] - self.val[i]) * vrange1, 0])  # Change the second value of RGB, from yellow to red
-                tmp = (self.val[i] - self.vmin[None]) * vrange1
-                self.color[i] = color_map(tmp)
+                ti.atomic_max(self.vmax[None], self.val[i])
+                ti.atomic_min(self.vmin[None], self.val[i])
+        self.val_to_color()
@@ -19,6 +19,18 @@ class SPHSolver:
         self.dt = ti.field(float, shape=())
         self.dt[None] = ti.max(1e-6, 0.2 * self.ps.smoothing_len / self.usound)  # CFL
         self.epsilon = 1e-16
+        self.step_num = 0
+        self.reorder_interval = 50  # steps between two Morton reorderings of the particles
+
+        # Kernel normalisation constants, computed once instead of in every particle pair
+        self.h1 = 1.0 / self.ps.smoothing_len
+        k_cubic = 1.0 if self.ps.dim == 1 else 15 / 7 / np.pi if self.ps.dim == 2 else 3 / 2 / np.pi
+        self.k_cubic_W = k_cubic * self.h1**self.ps.dim
+        self.k_cubic_dW = 6.0 * self.k_cubic_W
+        self.k_WendlandC2 = (7 / (4 * np.pi) if self.ps.dim == 2 else 21 / (2 * np.pi) if self.ps.dim == 3 else 0.0) * self.h1**self.ps.dim
+
+        # kernel derivative of each neighbour pair, aligned with ps.particle_neighbors, filled by neighbor_iter_and_cal_L and reused by the later loops of the same step
+        self.neighbors_dW = ti.Vector.field(self.ps.dim, dtype=float, shape=self.ps.particle_neighbors.shape)
 
     ###########################################################################
     # Assist
@@ -29,37 +41,64 @@ class SPHSolver:
             if self.ps.material[p_i] < 10:
                 self.ps.val[p_i] = 0.0
 
+    # analytic inverse of a 2x2 matrix, a singular matrix (no neighbours) gives a zero matrix instead of inf
+    @ti.func
+    def inv2x2(self, M):
+        det = M[0, 0] * M[1, 1] - M[0, 1] * M[1, 0]
+        inv_det = ti.math.sign(det) / ti.max(ti.abs(det), self.epsilon)
+        return ti.Matrix([[M[1, 1], -M[0, 1]], [-M[1, 0], M[0, 0]]]) * inv_det
+
     @ti.kernel
-    def cal_L(self):
+    def neighbor_iter_and_cal_L(self):
         # * calculate the normalisation matrix @bui2021, equation 21 (https://doi.org/10.1016/j.compgeo.2021.104315)
+        # * fused with ps.fill_neighbors: accumulate L during the grid scan and emit the packed neighbour list for the later loops
         for p_i in range(self.ps.particle_num[None]):
             x_i = self.ps.x[p_i]
             tmpL = ti.Matrix([[0.0 for _ in range(self.ps.dim)] for _ in range(self.ps.dim)])
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                x_j = self.ps.x[p_j]
-                tmp = self.kernel_derivative(x_i - x_j)
-                tmpL += self.ps.m_V * (x_j - x_i) @ tmp.transpose()
-            self.ps.L[p_i] = tmpL.inverse()
+            start = self.ps.particle_neighbors_offset[p_i]
+            end = self.ps.particle_neighbors_offset[p_i + 1]
+            if end > start:
+                center_cell = self.ps.pos_to_index(x_i)
+                cnt = start
+                lo = ti.max(center_cell - 1, 0)
+                hi = ti.min(center_cell + 2, ti.Vector(self.ps.grid_num))
+                for cell in ti.grouped(ti.ndrange(*[(lo[d], hi[d]) for d in ti.static(range(self.ps.dim))])):
+                    if cnt >= end:
+                        break
+                    for b in range((self.ps.grid_particles_num[cell] + self.ps.neighbor_batch - 1) // self.ps.neighbor_batch):
+                        p_j = self.ps.neighbors_in_batch(p_i, cell, b)
+                        for k in ti.static(range(self.ps.neighbor_batch)):
+                            if p_j[k] >= 0 and cnt < end:
+                                x_j = self.ps.x[p_j[k]]
+                                tmp = self.kernel_derivative(x_i - x_j)
+                                self.ps.particle_neighbors[cnt] = p_j[k]
+                                self.neighbors_dW[cnt] = tmp
+                                cnt += 1
+                                tmpL += self.ps.m_V * (x_j - x_i) @ tmp.transpose()
+            if ti.static(self.ps.dim == 2):
+                self.ps.L[p_i] = self.inv2x2(tmpL)
+            else:
+                self.ps.L[p_i] = tmpL.inverse()
 
     ###########################################################################
     # Kernel functions
     ###########################################################################
+    # * flag_kernel is resolved at compile time, only the chosen kernel is compiled into the neighbour loops
     @ti.func
     def kernel(self, r):
         res = ti.cast(0.0, ti.f32)
-        if self.flag_kernel == 1:
+        if ti.static(self.flag_kernel == 1):
             res = self.cubic_kernel(r)
-        elif self.flag_kernel == 2:
+        elif ti.static(self.flag_kernel == 2):
             res = self.WendlandC2_kernel(r)
         return res
 
     @ti.func
     def kernel_derivative(self, r):
         res = ti.Vector([0.0 for _ in range(self.ps.dim)])
-        if self.flag_kernel == 1:
+        if ti.static(self.flag_kernel == 1):
             res = self.cubic_kernel_derivative(r)
-        elif self.flag_kernel == 2:
+        elif ti.static(self.flag_kernel == 2):
             res = self.WendlandC2_kernel_derivative(r)
         return res
 
@@ -67,90 +106,74 @@ class SPHSolver:
     @ti.func
     def cubic_kernel(self, r):
         res = ti.cast(0.0, ti.f32)
-        h1 = 1 / self.ps.smoothing_len
-        k = 1 if self.ps.dim == 1 else 15 / 7 / np.pi if self.ps.dim == 2 else 3 / 2 / np.pi
-        k *= h1**self.ps.dim
         r_norm = r.norm()
-        q = r_norm * h1
+        q = r_norm * self.h1
         if r_norm > self.epsilon and q <= 2.0:
             if q <= 1.0:
                 q2 = q * q
                 q3 = q2 * q
-                res = k * (0.5 * q3 - q2 + 2 / 3)
+                res = self.k_cubic_W * (0.5 * q3 - q2 + 2 / 3)
             else:
-                res = k / 6 * ti.pow(2 - q, 3.0)
+                factor = 2.0 - q
+                res = self.k_cubic_W / 6 * factor * factor * factor
         return res
 
     @ti.func
     def cubic_kernel_derivative(self, r):
         res = ti.Vector([0.0 for _ in range(self.ps.dim)])
-        h1 = 1 / self.ps.smoothing_len
-        k = 1 if self.ps.dim == 1 else 15 / 7 / np.pi if self.ps.dim == 2 else 3 / 2 / np.pi
-        k *= 6. * h1**self.ps.dim
         r_norm = r.norm()
-        q = r_norm * h1
+        q = r_norm * self.h1
         if r_norm > self.epsilon and q <= 2.0:
-            grad_q = r / r_norm * h1
+            grad_q = r / r_norm * self.h1
             if q <= 1.0:
-                res = k * q * (3.0 / 2.0 * q - 2.0) * grad_q
+                res = self.k_cubic_dW * q * (3.0 / 2.0 * q - 2.0) * grad_q
             else:
                 factor = 2.0 - q
-                res = k * (-0.5 * factor * factor) * grad_q
+                res = self.k_cubic_dW * (-0.5 * factor * factor) * grad_q
         return res
 
     # Wendland C2 kernel
     @ti.func
     def WendlandC2_kernel(self, r):
         res = ti.cast(0.0, ti.f32)
-        h1 = 1 / self.ps.smoothing_len
-        k = 7 / (4 * np.pi) if self.ps.dim == 2 else 21 / (2 * np.pi) if self.ps.dim == 3 else 0.0
-        k *= h1**self.ps.dim
         r_norm = r.norm()
-        q = r_norm * h1
+        q = r_norm * self.h1
         if r_norm > self.epsilon and q <= 2.0:
             q1 = 1 - 0.5 * q
-            res = k * ti.pow(q1, 4) * (1 + 2 * q)
+            q1_2 = q1 * q1
+            res = self.k_WendlandC2 * q1_2 * q1_2 * (1 + 2 * q)
         return res
 
     @ti.func
     def WendlandC2_kernel_derivative(self, r):
         res = ti.Vector([0.0 for _ in range(self.ps.dim)])
-        h1 = 1 / self.ps.smoothing_len
-        k = 7 / (4 * np.pi) if self.ps.dim == 2 else 21 / (2 * np.pi) if self.ps.dim == 3 else 0.0
-        k *= h1**self.ps.dim
         r_norm = r.norm()
-        q = r_norm * h1
+        q = r_norm * self.h1
         if r_norm > self.epsilon and q <= 2.0:
             q1 = 1 - 0.5 * q
-            res = k * ti.pow(q1, 3) * (-5 * q) * h1 * r / r_norm
+            res = self.k_WendlandC2 * q1 * q1 * q1 * (-5 * q) * self.h1 * r / r_norm
         return res
 
     ###########################################################################
     # Boundary treatment
     ###########################################################################
     # Collision factor, assume roughly (1-c_f)*velocity loss after collision
+    # * branchless: the penetration depth on each side is 0 for particles inside the world, so they get zero correction
     @ti.func
-    def simulate_collisions(self, p_i, vec, d):
-        # if self.ps.material[p_i] < 10:
-        # assert d > self.ps.grid_size, 'My Error 2: particle goes out of the padding! d = %f, vec = [%f, %f], xo[%d] = [%f, %f]' % (d, vec[0], vec[1], p_i, self.ps.x[p_i][0], self.ps.x[p_i][1])
+    def simulate_collisions(self, p_i, pen_lo, pen_hi):
+        # assert (pen_lo + pen_hi).max() < self.ps.grid_size, 'My Error 2: particle goes out of the padding! pen_lo = [%f, %f], pen_hi = [%f, %f], xo[%d] = [%f, %f]' % (pen_lo[0], pen_lo[1], pen_hi[0], pen_hi[1], p_i, self.ps.x[p_i][0], self.ps.x[p_i][1])
         c_f = 0.7
-        self.ps.x[p_i] += (1.0 + c_f) * vec * d
-        self.ps.u[p_i] -= (1.0 + c_f) * (self.ps.u[p_i].dot(vec)) * vec
+        hit = ti.cast((pen_lo + pen_hi) > 0.0, float)
+        self.ps.x[p_i] += (1.0 + c_f) * (pen_lo - pen_hi)
+        self.ps.u[p_i] -= (1.0 + c_f) * hit * self.ps.u[p_i]
 
     @ti.kernel
     def enforce_boundary(self):
+        world = ti.Vector(self.ps.world)
         for p_i in range(self.ps.particle_num[None]):
-            if self.ps.dim == 2:
-                if self.ps.material[p_i] < 10:
-                    pos = self.ps.x[p_i]
-                    if pos[0] < 0:
-                        self.simulate_collisions(p_i, ti.Vector([1.0, 0.0]), -pos[0])
-                    if pos[0] > self.ps.world[0]:
-                        self.simulate_collisions(p_i, ti.Vector([-1.0, 0.0]), pos[0] - self.ps.world[0])
-                    if pos[1] > self.ps.world[1]:
-                        self.simulate_collisions(p_i, ti.Vector([0.0, -1.0]), pos[1] - self.ps.world[1])
-                    if pos[1] < 0:
-                        self.simulate_collisions(p_i, ti.Vector([0.0, 1.0]), -pos[1])
+            if self.ps.material[p_i] < 10:
+                pos = self.ps.x[p_i]
+                self.simulate_collisions(p_i, ti.max(-pos, 0.0), ti.max(pos - world, 0.0))
 
     @ti.func
     def cal_d_BA(self, p_i, p_j):
@@ -164,16 +187,11 @@ class SPHSolver:
         db_j = ti.Vector([x_j[1] - boundary[0], x_j[1] - boundary[1], x_j[0] - boundary[2], x_j[0] - boundary[3]])
 
         flag_b = db_i * db_j
-        flag_dir = flag_b < 0
+        flag_dir = ti.cast(flag_b < 0, float)   # kept in float, no i32/f32 mixing below
 
         if flag_dir.sum() > 1:
             flag_choose = abs(flag_dir * db_i)
-            tmp_max = 0
-            for i in ti.static(range(4)):
-                tmp_max = max(tmp_max, flag_choose[i])
-            flag_choose -= tmp_max
-            flag_choose = flag_choose == 0.0
-            flag_dir -= flag_choose     # will cause a warning: Local store may lose precision & Atomic add (i32 to f32) may lose precision
+            flag_dir -= ti.cast(flag_choose >= flag_choose.max(), float)
 
         d_A = abs(db_i.dot(flag_dir))
         d_B = abs(db_j.dot(flag_dir))
@@ -187,8 +205,11 @@ class SPHSolver:
         pass
 
     def step(self):
-        self.ps.initialize_particle_system()
-        self.cal_L()
+        if self.step_num % self.reorder_interval == 0:
+            self.ps.reorder_by_morton()
+        self.step_num += 1
+        self.ps.initialize_particle_system(fill_list=False)
+        self.neighbor_iter_and_cal_L()
         if self.TDmethod == 1:
             self.substep_SympEuler()
         self.enforce_boundary()
@@ -44,15 +44,13 @@ class WCSESPHSolver(SPHSolver):
         for p_i in range(self.ps.particle_num[None]):
             if self.ps.material[p_i] != self.ps.material_fluid:
                 continue
-            x_i = self.ps.x[p_i]
             drho = 0.0
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                x_j = self.ps.x[p_j]
+            for j in range(self.ps.particle_neighbors_offset[p_i], self.ps.particle_neighbors_offset[p_i + 1]):
+                p_j = self.ps.particle_neighbors[j]
                 if self.ps.material[p_j] == self.ps.material_dummy:
                     self.update_boundary_particles(p_i, p_j)
-                # tmp = (self.ps.u[p_i] - self.ps.u[p_j]).transpose() @ self.kernel_derivative(x_i - x_j)   # ! no normalisation
-                tmp = (self.ps.u[p_i] - self.ps.u[p_j]).transpose() @ (self.ps.L[p_i] @ self.kernel_derivative(x_i - x_j))    # ! normalised
+                # tmp = (self.ps.u[p_i] - self.ps.u[p_j]).transpose() @ self.neighbors_dW[j]   # ! no normalisation
+                tmp = (self.ps.u[p_i] - self.ps.u[p_j]).transpose() @ (self.ps.L[p_i] @ self.neighbors_dW[j])    # ! normalised
                 drho += self.ps.density[p_j] * self.ps.m_V * tmp[0]
             self.d_density[p_i] = drho
 
@@ -63,8 +61,8 @@ class WCSESPHSolver(SPHSolver):
                 continue
             x_i = self.ps.x[p_i]
             self.ps.density[p_i] = 0.0
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
+            for j in range(self.ps.particle_neighbors_offset[p_i], self.ps.particle_neighbors_offset[p_i + 1]):
+                p_j = self.ps.particle_neighbors[j]
                 x_j = self.ps.x[p_j]
                 if self.ps.material[p_j] == self.ps.material_dummy:
                     self.update_boundary_particles(p_i, p_j)
@@ -74,10 +72,10 @@ class WCSESPHSolver(SPHSolver):
 
     # Compute the viscosity force contribution, Anti-symmetric formula
     @ti.func
-    def viscosity_force(self, p_i, p_j, r):
+    def viscosity_force(self, p_i, p_j, r, dW):
         v_xy = (self.ps.u[p_i] - self.ps.u[p_j]).dot(r)
-        # res = 2 * (self.ps.dim + 2) * self.viscosity * (self.mass / (self.ps.density[p_j])) * v_xy / (r.norm()**2 + 0.01 * self.ps.smoothing_len**2) * self.kernel_derivative(r)   # ! no normalisation
-        res = 2 * (self.ps.dim + 2) * self.viscosity * (self.mass / (self.ps.density[p_j])) * v_xy / (r.norm()**2 + 0.01 * self.ps.smoothing_len**2) * (self.ps.L[p_i] @ self.kernel_derivative(r))    # ! normalised
+        # res = 2 * (self.ps.dim + 2) * self.viscosity * (self.mass / (self.ps.density[p_j])) * v_xy / (r.dot(r) + 0.01 * self.ps.smoothing_len**2) * dW   # ! no normalisation
+        res = 2 * (self.ps.dim + 2) * self.viscosity * (self.mass / (self.ps.density[p_j])) * v_xy / (r.dot(r) + 0.01 * self.ps.smoothing_len**2) * (self.ps.L[p_i] @ dW)    # ! normalised
         return res
 
     # Evaluate viscosity and add gravity
@@ -88,12 +86,12 @@ class WCSESPHSolver(SPHSolver):
                 continue
             x_i = self.ps.x[p_i]
             d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
+            for j in range(self.ps.particle_neighbors_offset[p_i], self.ps.particle_neighbors_offset[p_i + 1]):
+                p_j = self.ps.particle_neighbors[j]
                 x_j = self.ps.x[p_j]
                 if self.ps.material[p_j] == self.ps.material_dummy:
                     self.update_boundary_particles(p_i, p_j)
-                d_v += self.viscosity_force(p_i, p_j, x_i - x_j)
+                d_v += self.viscosity_force(p_i, p_j, x_i - x_j, self.neighbors_dW[j])
 
             # Add body force
             if self.ps.material[p_i] == self.ps.material_fluid:
@@ -104,9 +102,9 @@ class WCSESPHSolver(SPHSolver):
 
     # Compute the pressure force contribution, Symmetric formula
     @ti.func
-    def pressure_force(self, p_i, p_j, r):
-        # res = -self.mass * (self.pressure[p_i] / self.ps.density[p_i]**2 + self.pressure[p_j] / self.ps.density[p_j]**2) * self.kernel_derivative(r)   # ! no normalisation
-        res = -self.mass * (self.pressure[p_i] / self.ps.density[p_i]**2 + self.pressure[p_j] / self.ps.density[p_j]**2) * (self.ps.L[p_i] @ self.kernel_derivative(r))    # ! normalised
+    def pressure_force(self, p_i, p_j, dW):
+        # res = -self.mass * (self.pressure[p_i] / self.ps.density[p_i]**2 + self.pressure[p_j] / self.ps.density[p_j]**2) * dW   # ! no normalisation
+        res = -self.mass * (self.pressure[p_i] / self.ps.density[p_i]**2 + self.pressure[p_j] / self.ps.density[p_j]**2) * (self.ps.L[p_i] @ dW)    # ! normalised
         return res
 
     # Evaluate pressure force
@@ -119,14 +117,12 @@ class WCSESPHSolver(SPHSolver):
         for p_i in range(self.ps.particle_num[None]):
             if self.ps.material[p_i] != self.ps.material_fluid:
                 continue
-            x_i = self.ps.x[p_i]
             d_v = ti.Vector([0.0 for _ in range(self.ps.dim)])
-            for j in range(self.ps.particle_neighbors_num[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                x_j = self.ps.x[p_j]
+            for j in range(self.ps.particle_neighbors_offset[p_i], self.ps.particle_neighbors_offset[p_i + 1]):
+                p_j = self.ps.particle_neighbors[j]
                 if self.ps.material[p_j] == self.ps.material_dummy:
                     self.update_boundary_particles(p_i, p_j)
-                d_v += self.pressure_force(p_i, p_j, x_i - x_j)
+                d_v += self.pressure_force(p_i, p_j, self.neighbors_dW[j])
             self.d_velocity[p_i] += d_v
 
     # Symplectic Euler
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import taichi as ti
+from eng.particle_system import ParticleSystem
+
+
+@pytest.fixture
+def ps():
+    ti.init(arch=ti.cpu)
+    ps = ParticleSystem([0.1, 0.1], 0.002)
+    ps.add_cube(lower_corner=[0.0, 0], cube_size=[0.03, 0.05], material=1, density=1000.0)
+    return ps
+
+
+def brute_force_neighbors(ps):
+    n = ps.particle_num[None]
+    x = ps.x.to_numpy()[:n].astype(np.float64)
+    dist_sq = ((x[:, None, :] - x[None, :, :])**2).sum(-1)
+    within = dist_sq < ps.support_radius_sq
+    np.fill_diagonal(within, False)
+    within[ps.material.to_numpy()[:n] == ps.material_dummy] = False     # rangeary particles are skipped in NS
+    return within
+
+
+def test_neighbor_counts_match_brute_force(ps):
+    n = ps.particle_num[None]
+    expected = brute_force_neighbors(ps).sum(1)
+    assert expected.max() > ps.neighbor_batch     # more neighbours than a single batch
+    np.testing.assert_array_equal(ps.particle_neighbors_num.to_numpy()[:n], expected)
+
+
+def test_neighbor_lists_match_brute_force(ps):
+    n = ps.particle_num[None]
+    within = brute_force_neighbors(ps)
+    offset = ps.particle_neighbors_offset.to_numpy()
+    neighbors = ps.particle_neighbors.to_numpy()
+    for p_i in range(n):
+        assert sorted(neighbors[offset[p_i]:offset[p_i + 1]]) == list(np.flatnonzero(within[p_i]))
+
+
+def test_full_cell_is_an_error(ps):
+    # 10 x 10 particles packed into a single cell, more than particle_max_num_per_cell
+    with pytest.raises(AssertionError, match='particle_max_num_per_cell'):
+        ps.add_cube(lower_corner=[0.07, 0.07], cube_size=[0.004, 0.004], material=1, density=1000.0, offset=0.0002)
@@ -0,0 +1,32 @@
+import pytest
+import taichi as ti
+from eng.particle_system import ParticleSystem
+from eng.wcsesph import WCSESPHSolver
+
+
+@pytest.fixture
+def solver():
+    ti.init(arch=ti.cpu)
+    ps = ParticleSystem([0.1, 0.1], 0.001)    # grid_size = 0.006, the lower boundaries lie at x = 0.006 and y = 0.006
+    return WCSESPHSolver(ps, TDmethod=1, kernel=2, visco=0.00005, stiff=50000, expo=7)
+
+
+def d_BA(solver, x_i, x_j):
+    solver.ps.x[0] = x_i
+    solver.ps.x[1] = x_j
+
+    @ti.kernel
+    def cal() -> float:
+        return solver.cal_d_BA(0, 1)
+
+    return cal()
+
+
+def test_cal_d_BA_edge(solver):
+    # the pair crosses only the bottom boundary
+    assert d_BA(solver, [0.05, 0.008], [0.05, 0.002]) == pytest.approx(2.0, rel=1e-5)
+
+
+def test_cal_d_BA_corner_picks_nearest_boundary(solver):
+    # the pair crosses the bottom and the left boundary, A is nearer to the bottom one: d_A = 0.002, d_B = 0.004
+    assert d_BA(solver, [0.010, 0.008], [0.003, 0.002]) == pytest.approx(2.0, rel=1e-5)